@@ -3,58 +3,177 @@ API Service - Unified Ingestion Gateway
 Handles POST /ingest endpoint for JSON and TXT payloads
 """
 import os
-import json
+import asyncio
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
 import uuid
-from datetime import datetime
-from flask import Flask, request, jsonify
+from concurrent.futures import Future
+from time import gmtime, strftime, time
+import msgspec
+import zstandard as zstd
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
+from google.api_core import exceptions, retry
 from google.cloud import pubsub_v1
 
-app = Flask(__name__)
+# Log through a queue so request threads never block on stderr;
+# a background listener does the actual writes
+_log_queue = queue.Queue(-1)
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
+)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Configuration
 PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "your-project-id")
 TOPIC_ID = os.environ.get("PUBSUB_TOPIC_ID", "ingest-topic")
 
-# Initialize Pub/Sub publisher
-publisher = pubsub_v1.PublisherClient()
+# Initialize Pub/Sub publisher (thread-safe, shared by all requests)
+# Batching amortizes one publish RPC over up to 100 messages; flow control
+# caps outstanding messages so a burst can't exhaust memory, blocking new
+# publishes until earlier batches are acknowledged.
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(
+        max_messages=100,
+        max_bytes=1_000_000,
+        max_latency=0.01,
+    ),
+    publisher_options=pubsub_v1.types.PublisherOptions(
+        flow_control=pubsub_v1.types.PublishFlowControl(
+            message_limit=10_000,
+            byte_limit=10 * 1024 * 1024,
+            limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+        )
+    ),
+)
 topic_path = publisher.topic_path(PROJECT_ID, TOPIC_ID)
 
+# Short per-RPC timeout; transient broker errors are retried with
+# exponential backoff for up to PUBLISH_RETRY_DEADLINE_SECONDS
+PUBLISH_TIMEOUT_SECONDS = 5.0
+PUBLISH_RETRY_DEADLINE_SECONDS = 30.0
+
+PUBLISH_RETRY = retry.Retry(
+    predicate=retry.if_exception_type(
+        exceptions.ServiceUnavailable,
+        exceptions.DeadlineExceeded,
+        exceptions.InternalServerError,
+        exceptions.ResourceExhausted,
+        exceptions.Aborted,
+    ),
+    initial=0.1,
+    maximum=5.0,
+    multiplier=2.0,
+    deadline=PUBLISH_RETRY_DEADLINE_SECONDS,
+)
+
+# Pub/Sub rejects attribute values larger than this
+MAX_ATTRIBUTE_BYTES = 1024
+
+# Bodies larger than this are zstd-compressed before publishing
+COMPRESSION_THRESHOLD_BYTES = 1024
+
+# ZstdCompressor instances can't be shared between threads
+_local = threading.local()
 
-def normalize_to_internal_format(tenant_id: str, log_id: str, text: str, source: str) -> dict:
+
+def compress(data: bytes) -> bytes:
+    """zstd-compress data with a per-thread compressor."""
+    cctx = getattr(_local, "cctx", None)
+    if cctx is None:
+        cctx = _local.cctx = zstd.ZstdCompressor(level=3)
+    return cctx.compress(data)
+
+
+def utc_now_iso() -> str:
+    """Current UTC time as an ISO 8601 string with microseconds and a Z suffix."""
+    t = time()
+    return f"{strftime('%Y-%m-%dT%H:%M:%S', gmtime(t))}.{int(t % 1 * 1_000_000):06d}Z"
+
+
+def normalize_to_internal_format(tenant_id: str, log_id: str, text: bytes, source: str) -> dict:
     """
     Normalize all inputs to a single internal format.
     This creates a consistent message structure regardless of input type.
+    The text is kept as UTF-8 bytes, ready to publish.
     """
     return {
         "tenant_id": tenant_id,
         "log_id": log_id,
         "text": text,
         "source": source,
-        "received_at": datetime.utcnow().isoformat() + "Z"
+        "received_at": utc_now_iso()
     }
 
 
-def publish_to_pubsub(message: dict) -> str:
+def publish_to_pubsub(message: dict) -> Future:
     """
     Publish normalized message to Pub/Sub.
-    Returns the message ID on success.
+    Returns the publish future; it resolves to the message ID once the
+    batch containing this message has been acknowledged.
     """
-    message_json = json.dumps(message)
-    message_bytes = message_json.encode("utf-8")
+    # Only the text goes in the body; metadata travels as attributes
+    # so the worker doesn't need to parse the payload
+    attributes = {
+        "tenant_id": message["tenant_id"],
+        "log_id": message["log_id"],
+        "source": message["source"],
+        "received_at": message["received_at"]
+    }
+    
+    body = message["text"]
+    if len(body) > COMPRESSION_THRESHOLD_BYTES:
+        body = compress(body)
+        attributes["encoding"] = "zstd"
     
-    # Publish with tenant_id as attribute for potential filtering
     future = publisher.publish(
         topic_path,
-        message_bytes,
-        tenant_id=message["tenant_id"]
+        body,
+        retry=PUBLISH_RETRY,
+        timeout=PUBLISH_TIMEOUT_SECONDS,
+        **attributes
     )
-    return future.result()
+    future.add_done_callback(
+        lambda f: log_publish_error(f, message["tenant_id"], message["log_id"])
+    )
+    return future
+
+
+def log_publish_error(future: Future, tenant_id: str, log_id: str) -> None:
+    """Done callback for publishes: report failures, which /ingest doesn't wait on."""
+    exc = future.exception()
+    if exc is not None:
+        logger.error(
+            "Failed to publish log %s for tenant %s: %s", log_id, tenant_id, exc,
+            extra={"tenant_id": tenant_id, "log_id": log_id}
+        )
+
+
+class IngestRequest(msgspec.Struct):
+    """JSON body of an ingestion request. Empty fields are rejected in the handler."""
+    tenant_id: str = ""
+    text: str = ""
+    log_id: str | int | None = None
+
 
+def error_response(message: str, status_code: int) -> ORJSONResponse:
+    """Build a JSON error response."""
+    return ORJSONResponse({"error": message}, status_code=status_code)
 
-@app.route("/ingest", methods=["POST"])
-def ingest():
+
+async def parse_ingest_request(request: Request):
     """
-    Unified ingestion endpoint.
+    Validate an ingestion request and normalize it to the internal format.
     
     Handles two scenarios:
     1. JSON payload with Content-Type: application/json
@@ -63,97 +182,154 @@ def ingest():
     2. Plain text with Content-Type: text/plain
        Header: X-Tenant-ID: acme
        Body: Raw text string
+    
+    Returns the normalized message, or an error response if the request
+    is invalid.
     """
-    try:
-        content_type = request.content_type or ""
+    content_type = request.headers.get("content-type", "")
+    
+    # Scenario 1: JSON payload
+    if "application/json" in content_type:
+        # Parse and validate in one pass
+        try:
+            data = msgspec.json.decode(await request.body(), type=IngestRequest)
+        except msgspec.ValidationError as e:
+            return error_response(f"Invalid JSON payload: {e}", 400)
+        except msgspec.DecodeError:
+            return error_response("Invalid JSON payload", 400)
+        
+        # Validate required fields
+        if not data.tenant_id:
+            return error_response("Missing tenant_id", 400)
+        if not data.text:
+            return error_response("Missing text", 400)
         
-        # Scenario 1: JSON payload
-        if "application/json" in content_type:
-            data = request.get_json()
-            
-            if not data:
-                return jsonify({"error": "Invalid JSON payload"}), 400
-            
-            # Validate required fields
-            tenant_id = data.get("tenant_id")
-            text = data.get("text")
-            
-            if not tenant_id:
-                return jsonify({"error": "Missing tenant_id"}), 400
-            if not text:
-                return jsonify({"error": "Missing text"}), 400
-            
-            # Use provided log_id or generate one
-            log_id = data.get("log_id", str(uuid.uuid4()))
-            source = "json_upload"
+        tenant_id = data.tenant_id
+        text = data.text.encode("utf-8")
         
-        # Scenario 2: Plain text payload
-        elif "text/plain" in content_type:
-            # Extract tenant from header
-            tenant_id = request.headers.get("X-Tenant-ID")
-            
-            if not tenant_id:
-                return jsonify({"error": "Missing X-Tenant-ID header"}), 400
-            
-            text = request.get_data(as_text=True)
-            
-            if not text:
-                return jsonify({"error": "Empty text payload"}), 400
-            
-            # Generate log_id for text uploads
-            log_id = str(uuid.uuid4())
-            source = "text_upload"
+        # Use provided log_id or generate one; an empty log_id counts
+        # as missing (Pub/Sub attributes must be strings)
+        log_id = str(data.log_id) if data.log_id not in (None, "") else uuid.uuid4().hex
+        source = "json_upload"
+    
+    # Scenario 2: Plain text payload
+    elif "text/plain" in content_type:
+        # Extract tenant from header
+        tenant_id = request.headers.get("X-Tenant-ID")
         
-        else:
-            return jsonify({
-                "error": "Unsupported Content-Type. Use application/json or text/plain"
-            }), 415
+        if not tenant_id:
+            return error_response("Missing X-Tenant-ID header", 400)
         
-        # Normalize the data
-        normalized_message = normalize_to_internal_format(
-            tenant_id=tenant_id,
-            log_id=log_id,
-            text=text,
-            source=source
+        # Keep the raw bytes - no decode/re-encode of the payload
+        text = await request.body()
+        
+        if not text:
+            return error_response("Empty text payload", 400)
+        
+        # Generate log_id for text uploads
+        log_id = uuid.uuid4().hex
+        source = "text_upload"
+    
+    else:
+        return error_response(
+            "Unsupported Content-Type. Use application/json or text/plain", 415
         )
+    
+    # Both end up as Pub/Sub attributes; an oversized value would fail
+    # the whole publish batch, taking other requests' messages with it
+    if len(tenant_id.encode("utf-8")) > MAX_ATTRIBUTE_BYTES:
+        return error_response(f"tenant_id exceeds {MAX_ATTRIBUTE_BYTES} bytes", 400)
+    if len(log_id.encode("utf-8")) > MAX_ATTRIBUTE_BYTES:
+        return error_response(f"log_id exceeds {MAX_ATTRIBUTE_BYTES} bytes", 400)
+    
+    # Normalize the data
+    return normalize_to_internal_format(
+        tenant_id=tenant_id,
+        log_id=log_id,
+        text=text,
+        source=source
+    )
+
+
+@app.post("/ingest")
+async def ingest(request: Request):
+    """
+    Unified ingestion endpoint.
+    
+    Accepts JSON or plain text (see parse_ingest_request) and returns
+    202 as soon as the message is queued for publishing. Delivery to
+    Pub/Sub happens in the background batch; failures are logged.
+    """
+    try:
+        message = await parse_ingest_request(request)
+        if isinstance(message, ORJSONResponse):
+            return message
         
-        # Publish to Pub/Sub (async - non-blocking)
-        message_id = publish_to_pubsub(normalized_message)
+        # Queue for batched publish - don't wait for the broker ack.
+        # publish() blocks under flow control, so keep it off the event loop
+        await asyncio.to_thread(publish_to_pubsub, message)
         
         # Return 202 Accepted immediately
-        return jsonify({
+        return ORJSONResponse({
+            "status": "accepted",
+            "log_id": message["log_id"],
+            "tenant_id": message["tenant_id"]
+        }, status_code=202)
+    
+    except Exception as e:
+        logger.exception("Error processing request: %s", e)
+        return error_response("Internal server error", 500)
+
+
+@app.post("/ingest/sync")
+async def ingest_sync(request: Request):
+    """
+    Same as /ingest, but waits for Pub/Sub to acknowledge the message
+    and returns the broker message_id.
+    """
+    try:
+        message = await parse_ingest_request(request)
+        if isinstance(message, ORJSONResponse):
+            return message
+        
+        # Await the ack without blocking the event loop
+        future = await asyncio.to_thread(publish_to_pubsub, message)
+        message_id = await asyncio.wrap_future(future)
+        
+        return ORJSONResponse({
             "status": "accepted",
             "message_id": message_id,
-            "log_id": log_id,
-            "tenant_id": tenant_id
-        }), 202
+            "log_id": message["log_id"],
+            "tenant_id": message["tenant_id"]
+        }, status_code=202)
     
     except Exception as e:
-        # Log the error (in production, use proper logging)
-        print(f"Error processing request: {str(e)}")
-        return jsonify({"error": "Internal server error"}), 500
+        logger.exception("Error processing request: %s", e)
+        return error_response("Internal server error", 500)
 
 
-@app.route("/health", methods=["GET"])
-def health():
+@app.get("/health")
+async def health():
     """Health check endpoint for Cloud Run."""
-    return jsonify({"status": "healthy"}), 200
+    return {"status": "healthy"}
 
 
-@app.route("/", methods=["GET"])
-def root():
+@app.get("/")
+async def root():
     """Root endpoint with API info."""
-    return jsonify({
+    return {
         "service": "Unified Ingestion Gateway",
         "version": "1.0.0",
         "endpoints": {
             "POST /ingest": "Ingest JSON or TXT data",
+            "POST /ingest/sync": "Ingest and wait for the Pub/Sub message ID",
             "GET /health": "Health check"
         }
-    }), 200
+    }
 
 
 if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port, debug=False)
+    import uvicorn
 
+    port = int(os.environ.get("PORT", 8080))
+    uvicorn.run(app, host="0.0.0.0", port=port)
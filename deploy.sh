@@ -33,6 +33,13 @@ REGION=${2:-us-central1}
 TOPIC_ID="ingest-topic"
 SUBSCRIPTION_ID="ingest-subscription"
 
+# The pull worker doesn't autoscale on Cloud Run, so it runs a fixed
+# number of instances. Capacity is WORKER_INSTANCES * MAX_CONCURRENT_MESSAGES
+# messages in flight: 2 * 300 = 600, i.e. ~1200 RPM even when every
+# message hits the 30s SIMULATE_LOAD cap.
+WORKER_INSTANCES=2
+MAX_CONCURRENT_MESSAGES=300
+
 echo -e "${GREEN}=== Deploying to GCP ===${NC}"
 echo "Project ID: $PROJECT_ID"
 echo "Region: $REGION"
@@ -73,7 +80,21 @@ gcloud run deploy ingest-api \
 API_URL=$(gcloud run services describe ingest-api --region $REGION --format="value(status.url)")
 echo -e "${GREEN}API deployed at: $API_URL${NC}"
 
+# Create Pub/Sub pull subscription (if not exists)
+# The worker consumes it with a streaming pull; an existing push
+# subscription is switched to pull by clearing its push endpoint.
+echo -e "${YELLOW}Creating Pub/Sub subscription...${NC}"
+gcloud pubsub subscriptions create $SUBSCRIPTION_ID \
+    --topic $TOPIC_ID \
+    --ack-deadline=60 \
+    --quiet 2>/dev/null || \
+gcloud pubsub subscriptions modify-push-config $SUBSCRIPTION_ID \
+    --push-endpoint="" \
+    --quiet
+
 # Deploy Worker service
+# Always-on CPU and a fixed instance count: the worker pulls messages in
+# the background rather than serving requests, so Cloud Run can't scale it
 echo -e "${YELLOW}Deploying Worker service...${NC}"
 cd ../worker
 gcloud run deploy ingest-worker \
@@ -81,37 +102,13 @@ gcloud run deploy ingest-worker \
     --platform managed \
     --region $REGION \
     --no-allow-unauthenticated \
-    --set-env-vars "GCP_PROJECT_ID=$PROJECT_ID" \
-    --timeout=300 \
+    --set-env-vars "GCP_PROJECT_ID=$PROJECT_ID,PUBSUB_SUBSCRIPTION_ID=$SUBSCRIPTION_ID,SIMULATE_LOAD=1,MAX_CONCURRENT_MESSAGES=$MAX_CONCURRENT_MESSAGES" \
+    --min-instances=$WORKER_INSTANCES \
+    --max-instances=$WORKER_INSTANCES \
+    --no-cpu-throttling \
     --quiet
 
-WORKER_URL=$(gcloud run services describe ingest-worker --region $REGION --format="value(status.url)")
-echo -e "${GREEN}Worker deployed at: $WORKER_URL${NC}"
-
-# Get service account for push authentication
-PROJECT_NUMBER=$(gcloud projects describe $PROJECT_ID --format="value(projectNumber)")
-SERVICE_ACCOUNT="service-${PROJECT_NUMBER}@gcp-sa-pubsub.iam.gserviceaccount.com"
-
-# Grant invoker role to Pub/Sub service account
-echo -e "${YELLOW}Granting Pub/Sub permission to invoke Worker...${NC}"
-gcloud run services add-iam-policy-binding ingest-worker \
-    --region $REGION \
-    --member="serviceAccount:$SERVICE_ACCOUNT" \
-    --role="roles/run.invoker" \
-    --quiet
-
-# Create Pub/Sub subscription (if not exists)
-echo -e "${YELLOW}Creating Pub/Sub subscription...${NC}"
-gcloud pubsub subscriptions create $SUBSCRIPTION_ID \
-    --topic $TOPIC_ID \
-    --push-endpoint=$WORKER_URL \
-    --push-auth-service-account=$SERVICE_ACCOUNT \
-    --ack-deadline=300 \
-    --quiet 2>/dev/null || \
-gcloud pubsub subscriptions update $SUBSCRIPTION_ID \
-    --push-endpoint=$WORKER_URL \
-    --push-auth-service-account=$SERVICE_ACCOUNT \
-    --quiet
+echo -e "${GREEN}Worker deployed${NC}"
 
 cd ..
 
@@ -0,0 +1,127 @@
+"""
+Tests for the worker's Firestore group commit.
+
+Drives save_to_firestore + flush_writes against the real BulkWriter with
+only the network send (BulkWriter._send) stubbed out.
+"""
+import importlib.util
+import pathlib
+import threading
+import time
+from unittest import mock
+
+import pytest
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import firestore
+from google.cloud.firestore_v1.bulk_writer import BulkWriter
+from google.cloud.firestore_v1.types import BatchWriteResponse, WriteResult
+from google.rpc import status_pb2
+
+WORKER_MAIN = pathlib.Path(__file__).resolve().parent.parent / "worker" / "main.py"
+
+
+@pytest.fixture
+def worker():
+    """Fresh import of worker/main.py with an offline Firestore client."""
+    client = firestore.Client(project="test-project", credentials=AnonymousCredentials())
+    spec = importlib.util.spec_from_file_location("worker_main", WORKER_MAIN)
+    module = importlib.util.module_from_spec(spec)
+    with mock.patch.object(firestore, "Client", return_value=client):
+        spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def sent_paths():
+    """Stub BulkWriter._send; records the document paths of every batch sent."""
+    sent = []
+
+    def fake_send(self, batch):
+        paths = [ref.path for ref in batch._document_references.values()]
+        sent.extend(paths)
+        return BatchWriteResponse(
+            write_results=[WriteResult() for _ in paths],
+            status=[status_pb2.Status(code=0) for _ in paths],
+        )
+
+    with mock.patch.object(BulkWriter, "_send", fake_send):
+        yield sent
+
+
+def save_in_background(worker, log_id: str, sent_paths: list):
+    """
+    Run save_to_firestore on a thread. Returns the thread and a dict that
+    gets a snapshot of the sent paths taken the moment the call returns.
+    """
+    result = {}
+
+    def run():
+        try:
+            worker.save_to_firestore(
+                tenant_id="acme",
+                log_id=log_id,
+                original_text="call 555-123-4567",
+                modified_text="call [REDACTED]",
+                source="json_upload",
+                received_at="2024-12-03T09:59:58Z",
+            )
+            result["sent_at_return"] = list(sent_paths)
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, result
+
+
+def flush_until_done(worker, thread: threading.Thread, timeout: float = 5.0) -> None:
+    """Tick flush_writes like the periodic flusher until the saver returns."""
+    deadline = time.monotonic() + timeout
+    while thread.is_alive() and time.monotonic() < deadline:
+        worker.flush_writes()
+        thread.join(0.05)
+    assert not thread.is_alive(), "save_to_firestore never returned"
+
+
+def test_write_is_sent_before_save_returns(worker, sent_paths):
+    # Repeat across several flushes: a BulkWriter turns into a no-op after
+    # its first flush(), so a regression would only show from the second
+    for i in range(3):
+        log_id = f"log-{i}"
+        thread, result = save_in_background(worker, log_id, sent_paths)
+        flush_until_done(worker, thread)
+
+        assert "error" not in result
+        assert f"tenants/acme/processed_logs/{log_id}" in result["sent_at_return"]
+
+
+def test_flush_without_writes_is_a_no_op(worker, sent_paths):
+    worker.flush_writes()
+
+    assert sent_paths == []
+    assert worker._flushes_started == 0
+
+
+def test_failed_flush_raises_in_waiter(worker, sent_paths):
+    thread, result = save_in_background(worker, "log-fail", sent_paths)
+
+    # Wait until the write is queued, then make the flush blow up
+    deadline = time.monotonic() + 5.0
+    while not worker._pending_writes and time.monotonic() < deadline:
+        time.sleep(0.01)
+    with mock.patch.object(BulkWriter, "close", side_effect=RuntimeError("boom")):
+        with pytest.raises(RuntimeError):
+            worker.flush_writes()
+    thread.join(5.0)
+
+    assert isinstance(result.get("error"), RuntimeError)
+
+
+def test_save_refused_after_shutdown(worker, sent_paths):
+    worker._stop_flushing.set()
+
+    thread, result = save_in_background(worker, "log-late", sent_paths)
+    thread.join(5.0)
+
+    assert isinstance(result.get("error"), RuntimeError)
+    assert sent_paths == []
@@ -1,50 +1,185 @@
 """
 Worker Service - Message Processor
-Triggered by Pub/Sub messages, processes data, and stores in Firestore.
+Pulls messages from Pub/Sub, processes data, and stores in Firestore.
 """
 import os
+import atexit
 import json
-import base64
-import time
+import logging
+import logging.handlers
+import queue
 import re
-from datetime import datetime
-from flask import Flask, request, jsonify
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+import zstandard as zstd
 from google.cloud import firestore
+from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
 
-app = Flask(__name__)
+# Log through a queue so message handlers never block on stderr;
+# a background listener does the actual writes
+_log_queue = queue.Queue(-1)
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
+)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "your-project-id")
+SUBSCRIPTION_ID = os.environ.get("PUBSUB_SUBSCRIPTION_ID", "ingest-subscription")
+
+# Maximum number of messages leased and processed concurrently per instance.
+# The worker doesn't autoscale (see README), so this times the instance
+# count is the pipeline's capacity.
+MAX_CONCURRENT_MESSAGES = int(os.environ.get("MAX_CONCURRENT_MESSAGES", 300))
 
 # Initialize Firestore client
 db = firestore.Client()
 
+# Large bodies arrive zstd-compressed (attribute encoding=zstd).
+# ZstdDecompressor instances can't be shared between threads.
+_local = threading.local()
+
+# Set SIMULATE_LOAD=1 to add the artificial per-character processing delay
+SIMULATE_LOAD = os.environ.get("SIMULATE_LOAD", "").lower() in ("1", "true", "yes")
+
+# Phone number patterns like: 555-0199, (555) 123-4567, 555.123.4567
+_PHONE_RE = re.compile(r'\b\d{3}[-.\s]?\d{3,4}[-.\s]?\d{4}\b')
+
+# Cheap prescan: text without any digit can't contain a phone number
+_HAS_DIGIT = re.compile(r'\d').search
+
+# Writes are queued on a BulkWriter and committed in batches
+FLUSH_INTERVAL_SECONDS = 0.5
+MAX_WRITE_ATTEMPTS = 5
+
+# Group commit: each flush interval gets its own BulkWriter. A flush swaps
+# in a fresh writer, then closes the old one outside the lock, so handlers
+# can keep queueing writes while it commits (and retries). A BulkWriter
+# can't be reused after flush() - later flushes are no-ops.
+#
+# Writers are numbered by generation; a write waits until the flush of
+# its generation has completed, so we only ack Pub/Sub once the document
+# is actually stored.
+_writer_lock = threading.Lock()  # guards the current writer (not thread-safe)
+_flush_cond = threading.Condition()
+_flushes_started = 0
+_flushes_completed = 0
+_pending_writes = 0
+_failed_writes = set()  # (generation, document path)
+_failed_flushes = set()  # generations
+_stop_flushing = threading.Event()
+
+
+def on_write_error(error, generation: int) -> bool:
+    """Retry failed writes a few times, then record them as failed."""
+    if error.attempts < MAX_WRITE_ATTEMPTS:
+        return True
+    
+    path = error.operation.reference.path
+    logger.error(
+        "Giving up on write to %s after %d attempts: %s",
+        path, error.attempts, error.message
+    )
+    with _flush_cond:
+        _failed_writes.add((generation, path))
+    return False
+
+
+def new_bulk_writer(generation: int):
+    """BulkWriter for the writes of one flush generation."""
+    writer = db.bulk_writer()
+    writer.on_write_error(lambda error, _: on_write_error(error, generation))
+    return writer
+
+
+bulk_writer = new_bulk_writer(1)
+
+
+def flush_writes() -> None:
+    """Commit the current writer's queued writes and wake up everyone waiting on them."""
+    global bulk_writer, _flushes_started, _flushes_completed, _pending_writes
+    
+    with _writer_lock:
+        if not _pending_writes:
+            return
+        
+        writer = bulk_writer
+        with _flush_cond:
+            _flushes_started += 1
+            generation = _flushes_started
+        bulk_writer = new_bulk_writer(generation + 1)
+        _pending_writes = 0
+    
+    try:
+        writer.close()
+    except Exception:
+        # Nothing in this flush can be assumed committed
+        with _flush_cond:
+            _failed_flushes.add(generation)
+        raise
+    finally:
+        with _flush_cond:
+            _flushes_completed = generation
+            _flush_cond.notify_all()
+
+
+def flush_periodically() -> None:
+    """Background loop committing queued writes every FLUSH_INTERVAL_SECONDS."""
+    while not _stop_flushing.wait(FLUSH_INTERVAL_SECONDS):
+        try:
+            flush_writes()
+        except Exception as e:
+            logger.exception("Error flushing Firestore writes: %s", e)
+
+
+def simulated_load_seconds(text: str) -> float:
+    """
+    Artificial processing delay for demos: 0.05 seconds per character
+    (100 chars = 5 seconds), capped at 30 seconds to prevent timeout
+    (Cloud Run default is 300s).
+    """
+    return min(len(text) * 0.05, 30)
+
 
 def simulate_heavy_processing(text: str) -> str:
     """
-    Simulate CPU-bound processing.
-    Sleeps 0.05 seconds per character (100 chars = 5 seconds).
-    
-    Also performs a simple "redaction" of phone numbers as an example
+    Perform a simple "redaction" of phone numbers as an example
     of data transformation.
     """
-    # Calculate sleep time based on text length
-    sleep_time = len(text) * 0.05
-    
-    # Cap at 30 seconds to prevent timeout (Cloud Run default is 300s)
-    sleep_time = min(sleep_time, 30)
-    
-    print(f"Processing {len(text)} characters, sleeping for {sleep_time:.2f} seconds")
-    time.sleep(sleep_time)
+    # Skip the full pattern on pure prose
+    if not _HAS_DIGIT(text):
+        return text
     
     # Simple redaction: replace phone number patterns with [REDACTED]
-    # Pattern matches formats like: 555-0199, (555) 123-4567, 555.123.4567
-    redacted_text = re.sub(
-        r'\b\d{3}[-.\s]?\d{3,4}[-.\s]?\d{4}\b',
-        '[REDACTED]',
-        text
-    )
+    redacted_text = _PHONE_RE.sub('[REDACTED]', text)
     
     return redacted_text
 
 
+def decompress(data: bytes) -> bytes:
+    """zstd-decompress data with a per-thread decompressor."""
+    dctx = getattr(_local, "dctx", None)
+    if dctx is None:
+        dctx = _local.dctx = zstd.ZstdDecompressor()
+    return dctx.decompress(data)
+
+
+@lru_cache(maxsize=10_000)
+def tenant_logs_collection(tenant_id: str) -> firestore.CollectionReference:
+    """The tenants/{tenant_id}/processed_logs collection, cached per tenant."""
+    return db.collection("tenants").document(tenant_id).collection("processed_logs")
+
+
 def save_to_firestore(tenant_id: str, log_id: str, original_text: str, 
                        modified_text: str, source: str, received_at: str) -> None:
     """
@@ -53,73 +188,99 @@ def save_to_firestore(tenant_id: str, log_id: str, original_text: str,
     Structure: tenants/{tenant_id}/processed_logs/{log_id}
     
     This ensures strict multi-tenant isolation using sub-collections.
+    
+    The write is queued on the current BulkWriter; this call blocks until
+    the periodic flush has committed it, and raises if it ultimately failed.
     """
+    global _pending_writes
+    
     # Reference to the document with tenant isolation
-    doc_ref = db.collection("tenants").document(tenant_id) \
-                .collection("processed_logs").document(log_id)
+    doc_ref = tenant_logs_collection(tenant_id).document(log_id)
     
     # Document data matching the required schema
+    # (processed_at is filled in by Firestore on commit)
     doc_data = {
         "source": source,
         "original_text": original_text,
         "modified_data": modified_text,
-        "processed_at": datetime.utcnow().isoformat() + "Z",
+        "processed_at": firestore.SERVER_TIMESTAMP,
         "received_at": received_at,
         "text_length": len(original_text)
     }
     
-    # Save to Firestore
-    doc_ref.set(doc_data)
-    print(f"Saved document: tenants/{tenant_id}/processed_logs/{log_id}")
+    # Queue the write on the current writer and wait for its flush
+    with _writer_lock:
+        # After shutdown starts the last flush may already have run;
+        # refuse the write so the message is nacked instead of hanging
+        if _stop_flushing.is_set():
+            raise RuntimeError(f"Shutting down, not writing {doc_ref.path}")
+        
+        bulk_writer.set(doc_ref, doc_data)
+        _pending_writes += 1
+        with _flush_cond:
+            generation = _flushes_started + 1
+    
+    with _flush_cond:
+        while _flushes_completed < generation:
+            _flush_cond.wait()
+        
+        if generation in _failed_flushes:
+            raise RuntimeError(f"Flush failed before committing {doc_ref.path}")
+        
+        failure = (generation, doc_ref.path)
+        if failure in _failed_writes:
+            _failed_writes.discard(failure)
+            raise RuntimeError(f"Failed to write {doc_ref.path}")
+    
+    logger.info(
+        "Saved document: tenants/%s/processed_logs/%s", tenant_id, log_id,
+        extra={"tenant_id": tenant_id, "log_id": log_id}
+    )
 
 
-@app.route("/", methods=["POST"])
-def process_pubsub():
+def handle_message(message) -> None:
     """
-    Handle Pub/Sub push messages.
-    
-    Pub/Sub delivers messages in this format:
-    {
-        "message": {
-            "data": "<base64-encoded-message>",
-            "attributes": {...},
-            "messageId": "...",
-            "publishTime": "..."
-        },
-        "subscription": "..."
-    }
+    Process a single Pub/Sub message.
+    
+    Called from the subscriber's thread pool. Metadata comes from the
+    message attributes, the body is the raw (possibly zstd-compressed) text.
+    The message is acked only after the Firestore write has been committed;
+    on failure it is nacked so Pub/Sub redelivers it.
     """
     try:
-        envelope = request.get_json()
-        
-        if not envelope:
-            return jsonify({"error": "No Pub/Sub message received"}), 400
-        
-        if "message" not in envelope:
-            return jsonify({"error": "Invalid Pub/Sub message format"}), 400
+        attributes = message.attributes
+        tenant_id = attributes.get("tenant_id")
+        log_id = attributes.get("log_id")
+        source = attributes.get("source")
+        received_at = attributes.get("received_at")
         
-        pubsub_message = envelope["message"]
-        
-        # Decode the base64 message data
-        if "data" in pubsub_message:
-            message_data = base64.b64decode(pubsub_message["data"]).decode("utf-8")
-            message = json.loads(message_data)
-        else:
-            return jsonify({"error": "No data in Pub/Sub message"}), 400
-        
-        # Extract fields from the normalized message
-        tenant_id = message.get("tenant_id")
-        log_id = message.get("log_id")
-        text = message.get("text")
-        source = message.get("source")
-        received_at = message.get("received_at")
+        # Decoded once here for redaction and storage; text/plain
+        # uploads are published as-is, so tolerate invalid UTF-8
+        data = message.data
+        if attributes.get("encoding") == "zstd":
+            data = decompress(data)
+        text = data.decode("utf-8", errors="replace")
         
         if not all([tenant_id, log_id, text, source]):
-            return jsonify({"error": "Missing required fields in message"}), 400
+            # Redelivery can't fix a malformed message - drop it
+            logger.warning("Dropping message %s: missing required fields", message.message_id)
+            message.ack()
+            return
+        
+        logger.info(
+            "Processing message for tenant: %s, log: %s", tenant_id, log_id,
+            extra={"tenant_id": tenant_id, "log_id": log_id}
+        )
         
-        print(f"Processing message for tenant: {tenant_id}, log: {log_id}")
+        # Artificial delay for demos; only holds this message's pool thread
+        if SIMULATE_LOAD:
+            sleep_time = simulated_load_seconds(text)
+            logger.info(
+                "Processing %d characters, sleeping for %.2f seconds", len(text), sleep_time
+            )
+            sleep(sleep_time)
         
-        # Simulate heavy processing
+        # Redact sensitive data
         modified_text = simulate_heavy_processing(text)
         
         # Save to Firestore with tenant isolation
@@ -132,28 +293,77 @@ def process_pubsub():
             received_at=received_at
         )
         
-        # Return 200 to acknowledge the message
-        # If we return anything other than 2xx, Pub/Sub will retry
-        return jsonify({
-            "status": "processed",
-            "tenant_id": tenant_id,
-            "log_id": log_id
-        }), 200
+        # Ack only once the document is stored
+        message.ack()
     
     except Exception as e:
-        print(f"Error processing message: {str(e)}")
-        # Return 500 to trigger Pub/Sub retry
+        logger.exception("Error processing message: %s", e)
+        # Nack to trigger Pub/Sub redelivery
         # This handles the "crash recovery" requirement
-        return jsonify({"error": str(e)}), 500
+        message.nack()
 
 
-@app.route("/health", methods=["GET"])
-def health():
-    """Health check endpoint."""
-    return jsonify({"status": "healthy"}), 200
+class HealthHandler(BaseHTTPRequestHandler):
+    """Minimal HTTP server so Cloud Run has a port to health-check."""
+    
+    def do_GET(self):
+        body = json.dumps({"status": "healthy"}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        # Don't log every health probe
+        pass
 
 
-if __name__ == "__main__":
+def main() -> None:
+    """Start the health server, the flush loop and the streaming pull."""
     port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port, debug=False)
+    health_server = ThreadingHTTPServer(("0.0.0.0", port), HealthHandler)
+    threading.Thread(target=health_server.serve_forever, daemon=True).start()
+    
+    flusher = threading.Thread(target=flush_periodically, daemon=True)
+    flusher.start()
+    
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(PROJECT_ID, SUBSCRIPTION_ID)
+    
+    # Each leased message gets its own thread, since handlers block
+    # until their write is flushed
+    streaming_pull_future = subscriber.subscribe(
+        subscription_path,
+        callback=handle_message,
+        flow_control=pubsub_v1.types.FlowControl(max_messages=MAX_CONCURRENT_MESSAGES),
+        scheduler=ThreadScheduler(
+            executor=ThreadPoolExecutor(max_workers=MAX_CONCURRENT_MESSAGES)
+        ),
+    )
+    logger.info("Listening for messages on %s", subscription_path)
+    
+    # Cloud Run stops containers with SIGTERM; turn it into a clean
+    # shutdown so queued writes get their final flush
+    def handle_sigterm(signum, frame):
+        logger.info("Received SIGTERM, stopping subscriber")
+        streaming_pull_future.cancel()
+    
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    
+    with subscriber:
+        try:
+            streaming_pull_future.result()
+        except BaseException as e:
+            logger.info("Stopping subscriber: %r", e)
+            streaming_pull_future.cancel()
+            streaming_pull_future.result()
+        finally:
+            _stop_flushing.set()
+            flusher.join()
+            flush_writes()
+            health_server.shutdown()
 
+
+if __name__ == "__main__":
+    main()